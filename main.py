@@ -1,41 +1,183 @@
-import json
+import orjson
 import urllib.request
 import csv
 import sys
 import requests
-from bs4 import BeautifulSoup
-import re
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
 import csv
 from tqdm import tqdm
-import json
 import concurrent.futures
+import multiprocessing
+import itertools
+import gzip
+import os
+import pathlib
+import tempfile
+import zlib
+
+# Number of worker threads used to fetch pages, also used to size the connection pool
+MAX_WORKERS = 64
+
+# Maximum number of pages being fetched or waiting to be parsed at any time
+MAX_IN_FLIGHT = 128
+
+# Shared session so that connections to kakimashou.com are kept alive and reused
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=MAX_WORKERS,
+        pool_maxsize=MAX_WORKERS,
+        max_retries=Retry(
+            total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]
+        ),
+    ),
+)
+
+# Parse workers are never forked from this process, as forking while fetch threads
+# hold urllib3 and SSL locks could leave those locks held in the children. A fork
+# server is used where the platform has one, such as Linux, and spawn otherwise
+PARSE_START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+# Fetched pages are cached here so that reruns only need to revalidate them
+CACHE_DIR = pathlib.Path(".cache")
+
+# Maximum number of note updates sent to AnkiConnect in a single request
+ANKI_BATCH_SIZE = 200
+
+# HTML lines showing a reading with its meaning on the Anki cards
+COMMON_READING_TEMPLATE = "%s <span style='font-size: 60%%;'>%s</span>"
+UNCOMMON_READING_TEMPLATE = (
+    "<span style='color: gray;'>%s</span> <span style='font-size: 60%%;'>%s</span>"
+)
+
+# Only the #bodyTag subtree, holding the readings and the usage tables, gets parsed
+STRAINER = SoupStrainer(id="bodyTag")
+
+# Nested divs leading from #bodyTag down to the readings div, as the classes each one
+# must carry and whether it must be the first element child of its parent
+READINGS_DIV_PATH = (
+    ((), False),
+    ((), False),
+    ((), False),
+    ((), True),
+    (("col-xl-8", "col-lg-7", "col-md-6"), False),
+    ((), False),
+    (("col-lg-9", "col-md-9", "col-sm-10"), False),
+    ((), False),
+)
+
+
+def read_cached_page(kanji):
+    """Reads the cached page of a kanji along with its validators, if any."""
+    try:
+        validators_line, _, html_content = gzip.decompress(
+            (CACHE_DIR / f"{kanji}.gz").read_bytes()
+        ).partition(b"\n")
+        validators = orjson.loads(validators_line)
+    except (OSError, EOFError, zlib.error, orjson.JSONDecodeError):
+        # A missing or damaged cache entry is simply fetched again
+        return None, None
+    if not isinstance(validators, dict):
+        return None, None
+    return validators, html_content
+
+
+def write_cached_page(kanji, validators, html_content):
+    """Atomically caches the page of a kanji together with its validators."""
+    temporary_path = None
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=CACHE_DIR, delete=False) as file:
+            temporary_path = file.name
+            file.write(gzip.compress(orjson.dumps(validators) + b"\n" + html_content))
+        os.replace(temporary_path, CACHE_DIR / f"{kanji}.gz")
+    except OSError as e:
+        print(f"Error caching data for {kanji}: {e}")
+        # Do not leave the partially written temporary file behind
+        if temporary_path:
+            try:
+                os.unlink(temporary_path)
+            except FileNotFoundError:
+                pass
 
 
 def fetch_html_content(kanji):
     """Fetches the HTML content of the kanji page from kakimashou.com."""
     url = f"https://www.kakimashou.com/dictionary/character/{kanji}"
+
+    # Revalidate the cached page if the server gave validators for it, else reuse it
+    validators, cached_content = read_cached_page(kanji)
+    headers = {}
+    if cached_content is not None:
+        if not validators:
+            return cached_content
+        if "ETag" in validators:
+            headers["If-None-Match"] = validators["ETag"]
+        if "Last-Modified" in validators:
+            headers["If-Modified-Since"] = validators["Last-Modified"]
+
     try:
-        response = requests.get(url)
-        response.encoding = "utf-8"
+        response = SESSION.get(url, headers=headers, timeout=(3, 10))
+        if response.status_code == 304:
+            return cached_content
         response.raise_for_status()
-        return BeautifulSoup(response.text, "html.parser")
     except requests.exceptions.RequestException as e:
         print(f"Error fetching data for {kanji}: {e}")
+        return cached_content
+
+    validators = {
+        name: response.headers[name]
+        for name in ("ETag", "Last-Modified")
+        if name in response.headers
+    }
+    write_cached_page(kanji, validators, response.content)
+    return response.content
+
+
+def find_div_path(tag, path):
+    """Finds the first div reached from a tag through a path of nested child divs."""
+    if not path:
+        return tag
+    classes, first_child = path[0]
+    for index, child in enumerate(tag.find_all(True, recursive=False)):
+        if first_child and index > 0:
+            break
+        if child.name == "div" and set(classes).issubset(child.get("class", ())):
+            # Backtrack to the next candidate when the rest of the path does not match
+            found = find_div_path(child, path[1:])
+            if found:
+                return found
+    return None
+
+
+def find_readings_div(soup):
+    """Walks down from #bodyTag to the div holding the kanji readings."""
+    body = soup.find(id="bodyTag")
+    if not body:
         return None
+    return find_div_path(body, READINGS_DIV_PATH)
 
 
 def extract_readings(readings_div):
     """Extracts kunyomi, onyomi, and nanori readings from the readings div."""
-    kunyomi = extract_reading_type(readings_div, "Kun'yomi")
-    onyomi = extract_reading_type(readings_div, "On'yomi")
-    nanori = extract_reading_type(readings_div, "Nanori")
+    # Collect the reading type headers in a single pass, keeping the first of each
+    headers = {}
+    for header in readings_div.find_all("h5"):
+        headers.setdefault(header.get_text(strip=True), header)
+    kunyomi = extract_reading_type(headers.get("Kun'yomi"))
+    onyomi = extract_reading_type(headers.get("On'yomi"))
+    nanori = extract_reading_type(headers.get("Nanori"))
     return kunyomi, onyomi, nanori
 
 
-def extract_reading_type(readings_div, reading_type):
+def extract_reading_type(header):
     """Extracts a specific type of reading (kunyomi, onyomi, or nanori)."""
     readings = {}
-    header = readings_div.find("h5", string=reading_type)
     if header:
         reading_list = header.find_next_sibling("ul")
         if reading_list:
@@ -47,62 +189,50 @@ def extract_reading_type(readings_div, reading_type):
                         cell.text for cell in reading_table.find_all("td") if cell.text
                     ).strip("-")
                     meaning = meaning_span.get_text(strip=True) if meaning_span else ""
-                    readings[reading] = readings.get(reading, "") + (
-                        ", " + meaning if readings.get(reading) else meaning
+                    existing = readings.get(reading)
+                    readings[reading] = (
+                        existing + ", " + meaning if existing else meaning
                     )
     return readings
 
 
 def extract_kanji_usage_data(soup):
-    """Extracts kanji usage data from the tables on the page."""
-    kanji_data = []
-    for table in soup.find_all("table"):
-        for row in table.find_all("tr"):
-            cells = row.find_all("td")
-            if len(cells) >= 2:
-                link = cells[0].find("a")
-                if link:
-                    reading_spans = link.find_all("span", class_="reading")
-                    readings = [
-                        "".join(
-                            child.string
-                            for child in span.children
-                            if child.string and child.name != "em"
-                        )
-                        for span in reading_spans
-                    ]
-                    if readings:
-                        reading = readings[0]
-                        percentage = float(cells[1].text.replace("%", ""))
-                        if percentage != 0.0:
-                            hiragana_reading = "".join(re.findall(r"[ぁ-ん]", reading))
-                            katakana_reading = "".join(re.findall(r"[ァ-ン]", reading))
-                            if hiragana_reading:
-                                kanji_data.append(
-                                    {
-                                        "reading": hiragana_reading,
-                                        "type": "hiragana",
-                                        "percentage": percentage,
-                                    }
-                                )
-                            if katakana_reading:
-                                kanji_data.append(
-                                    {
-                                        "reading": katakana_reading,
-                                        "type": "katakana",
-                                        "percentage": percentage,
-                                    }
-                                )
-    kanji_data.sort(key=lambda x: x["percentage"], reverse=True)
-    return kanji_data
-
-
-def filter_and_sort_readings(kunyomi, onyomi, nanori, kanji_usage_data):
-    """Filters out 0% commonality readings and sorts by percentage."""
-    reading_percentages = {
-        item["reading"]: item["percentage"] for item in kanji_usage_data
-    }
+    """Extracts the usage percentage of each reading from the tables on the page."""
+    reading_percentages = {}
+    for row in soup.find_all("tr"):
+        cells = row.find_all("td")
+        if len(cells) < 2:
+            continue
+        # Skip the rows of unused readings before doing any further work on them
+        percentage_text = cells[1].text.strip()
+        if percentage_text in ("0%", "0.0%"):
+            continue
+        link = cells[0].find("a")
+        if not link:
+            continue
+        reading_span = link.find("span", class_="reading")
+        if not reading_span:
+            continue
+        reading = "".join(
+            child.string
+            for child in reading_span.children
+            if child.string and child.name != "em"
+        )
+        percentage = float(percentage_text.replace("%", ""))
+        if percentage != 0.0:
+            hiragana_reading = "".join(char for char in reading if "ぁ" <= char <= "ん")
+            katakana_reading = "".join(char for char in reading if "ァ" <= char <= "ン")
+            # A reading listed more than once keeps its lowest percentage
+            for kana_reading in (hiragana_reading, katakana_reading):
+                if kana_reading:
+                    reading_percentages[kana_reading] = min(
+                        reading_percentages.get(kana_reading, percentage), percentage
+                    )
+    return reading_percentages
+
 
+def filter_and_sort_readings(kunyomi, onyomi, nanori, reading_percentages):
+    """Filters out 0% commonality readings and sorts by percentage."""
     return (
         filter_and_sort_reading_type(kunyomi, reading_percentages),
         filter_and_sort_reading_type(onyomi, reading_percentages),
@@ -123,23 +253,20 @@ def filter_and_sort_reading_type(reading_type_dict, reading_percentages):
     }
 
 
-def fetch_kanji_data(kanji):
-    """Fetches and processes kanji data for a given kanji."""
-    soup = fetch_html_content(kanji)
-    if not soup:
-        return None
-
-    readings_div = soup.select_one(
-        "#bodyTag > div > div > div > div:nth-child(1) > div.col-xl-8.col-lg-7.col-md-6 > div > div.col-lg-9.col-md-9.col-sm-10 > div"
+def parse_kanji_data(kanji, html_content):
+    """Processes the fetched HTML content of the page of a given kanji."""
+    soup = BeautifulSoup(
+        html_content, "lxml", parse_only=STRAINER, from_encoding="utf-8"
     )
+    readings_div = find_readings_div(soup)
     if not readings_div:
         print(f"Readings div not found for {kanji}")
         return None
 
     kunyomi, onyomi, nanori = extract_readings(readings_div)
-    kanji_usage_data = extract_kanji_usage_data(soup)
+    reading_percentages = extract_kanji_usage_data(soup)
     filtered_kunyomi, filtered_onyomi, filtered_nanori = filter_and_sort_readings(
-        kunyomi, onyomi, nanori, kanji_usage_data
+        kunyomi, onyomi, nanori, reading_percentages
     )
 
     return {
@@ -150,6 +277,53 @@ def fetch_kanji_data(kanji):
     }
 
 
+def fetch_kanji_records(kanjis, filepath):
+    """Fetches and processes the data of all kanji into a JSON lines file."""
+    # Pages are fetched by threads and parsed by processes, away from the GIL,
+    # and each parsed record is streamed to disk as soon as it is available
+    with open(filepath, "wb") as file, concurrent.futures.ThreadPoolExecutor(
+        max_workers=MAX_WORKERS
+    ) as fetch_executor, concurrent.futures.ProcessPoolExecutor(
+        mp_context=multiprocessing.get_context(PARSE_START_METHOD)
+    ) as parse_executor, tqdm(
+        total=len(kanjis),
+        desc="Fetching kanji data from kakimashou.com",
+        dynamic_ncols=True,
+        unit="kanji",
+        bar_format="Fetching kanji data: {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]",
+    ) as progress:
+        kanji_iterator = iter(kanjis)
+        fetch_futures = {}
+        parse_futures = set()
+        while True:
+            # Pages being fetched and pages waiting to be parsed share one cap, so
+            # fetched pages cannot pile up in front of slower parse workers
+            free_slots = MAX_IN_FLIGHT - len(fetch_futures) - len(parse_futures)
+            for kanji in itertools.islice(kanji_iterator, max(free_slots, 0)):
+                fetch_futures[fetch_executor.submit(fetch_html_content, kanji)] = kanji
+            if not fetch_futures and not parse_futures:
+                break
+
+            done, _ = concurrent.futures.wait(
+                [*fetch_futures, *parse_futures],
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                if future in parse_futures:
+                    parse_futures.remove(future)
+                    kanji_data = future.result()
+                    if kanji_data:
+                        file.write(orjson.dumps(kanji_data) + b"\n")
+                else:
+                    kanji = fetch_futures.pop(future)
+                    progress.update()
+                    html_content = future.result()
+                    if html_content:
+                        parse_futures.add(
+                            parse_executor.submit(parse_kanji_data, kanji, html_content)
+                        )
+
+
 def load_kanji_list(filepath):
     """Loads the list of kanji from a file."""
     try:
@@ -165,11 +339,11 @@ def request(action, **params):
 
 
 def invoke(action, **params):
-    requestJson = json.dumps(request(action, **params)).encode("utf-8")
-    response = json.load(
+    requestJson = orjson.dumps(request(action, **params))
+    response = orjson.loads(
         urllib.request.urlopen(
             urllib.request.Request("http://localhost:8765", requestJson)
-        )
+        ).read()
     )
     if len(response) != 2:
         raise Exception("response has an unexpected number of fields")
@@ -182,35 +356,82 @@ def invoke(action, **params):
     return response["result"]
 
 
+def invoke_multi(actions):
+    """Runs a list of actions in a single AnkiConnect request."""
+    results = invoke("multi", actions=actions)
+    for result in results:
+        if result["error"] is not None:
+            raise Exception(result["error"])
+    return [result["result"] for result in results]
+
+
+def find_deck_note_ids(deck):
+    """Maps each kanji of the given deck to the IDs of the notes holding it."""
+    note_ids = invoke("findNotes", query=f'"deck:{deck}"')
+    kanji_note_ids = {}
+    for note in invoke("notesInfo", notes=note_ids):
+        # Notes whose note type has no Kanji field are not kanji cards
+        kanji_field = note["fields"].get("Kanji")
+        if kanji_field:
+            kanji = kanji_field["value"].strip()
+            kanji_note_ids.setdefault(kanji, []).append(note["noteId"])
+    return kanji_note_ids
+
+
+def render_readings(readings):
+    """Renders readings as HTML lines, graying out the uncommon ones."""
+    return "<br>".join(
+        (
+            UNCOMMON_READING_TEMPLATE
+            if details["percentage"] < 1
+            else COMMON_READING_TEMPLATE
+        )
+        % (reading, details["meaning"])
+        for reading, details in readings.items()
+    )
+
+
+def prepare_note_updates(kanji_entry, note_ids):
+    """Prepares the updateNoteFields actions filling in the readings of a kanji."""
+    # Prepare the readings with <br> tags for line breaks
+    katakana_reading = render_readings(kanji_entry.get("onyomi", {}))
+    hiragana_reading = render_readings(kanji_entry.get("kunyomi", {}))
+    names_reading = render_readings(kanji_entry.get("nanori", {}))
+
+    return [
+        request(
+            "updateNoteFields",
+            note={
+                "id": note_id,
+                "fields": {
+                    "KatakanaReading": katakana_reading,
+                    "HiraganaReading": hiragana_reading,
+                    "NamesReadings": names_reading,
+                },
+            },
+        )
+        for note_id in note_ids
+    ]
+
+
 def main():
     """Main function to fetch and save kanji data."""
     kanjis = load_kanji_list("All JLPT Kanjis.txt")
     if not kanjis:
         return
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        kanji_data = list(
-            tqdm(
-                executor.map(fetch_kanji_data, kanjis),
-                total=len(kanjis),
-                desc="Fetching kanji data from kakimashou.com",
-                dynamic_ncols=True,
-                unit="kanji",
-                bar_format="Fetching kanji data: {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]",
-            )
-        )
+    fetch_kanji_records(kanjis, "kanji_data.jsonl")
 
-    kanji_data = [data for data in kanji_data if data]
+    # Gather the records back in the order of the kanji list
+    with open("kanji_data.jsonl", "rb") as file:
+        kanji_index = {entry["kanji"]: entry for entry in map(orjson.loads, file)}
+    kanji_data = [kanji_index[kanji] for kanji in kanjis if kanji in kanji_index]
 
-    with open("kanji_data.json", "w") as file:
-        json.dump(kanji_data, file, indent=4, ensure_ascii=False)
+    with open("kanji_data.json", "wb") as file:
+        file.write(orjson.dumps(kanji_data, option=orjson.OPT_INDENT_2))
 
     print("Kanji data saved to kanji_data.json")
 
-    # Load the dictionary from the JSON file
-    with open("kanji_data.json", "r", encoding="utf-8") as f:
-        kanji_data = json.load(f)
-
     reference_kanjis = []
     # Parse the CSV file and get the second column
     with open("All JLPT Kanjis.txt", "r") as file:
@@ -218,92 +439,29 @@ def main():
         for row in reader:
             reference_kanjis.append(row[0])
 
-    # Iterate through each kanji in reference_kanjis with tqdm progress bar
-    for target_kanji in tqdm(
-        reference_kanjis,
-        desc="Updating the Anki deck",
-        unit="kanji",
-    ):
-        kanji_entry = None
-        for entry in kanji_data:
-            if entry["kanji"] == target_kanji:
-                kanji_entry = entry
-                break
+    # Find the note IDs of every kanji in the Anki deck at once
+    kanji_note_ids = find_deck_note_ids("All JLPT Kanjis")
+
+    actions = []
+    for target_kanji in reference_kanjis:
+        kanji_entry = kanji_index.get(target_kanji)
+        note_ids = kanji_note_ids.get(target_kanji)
 
         if kanji_entry is None:
             print(f"Kanji '{target_kanji}' not found in the JSON data")
+        elif not note_ids:
+            print(f"No notes found for '{target_kanji}' in the 'All JLPT Kanjis' deck")
         else:
-            # Prepare the readings with <br> tags for line breaks
-            katakana_readings = []
-            hiragana_readings = []
-            names_readings = []
-
-            if "onyomi" in kanji_entry:
-                for reading, details in kanji_entry["onyomi"].items():
-                    meaning = details["meaning"]
-                    percentage = details["percentage"]
-                    if percentage < 1:
-                        katakana_readings.append(
-                            f"<span style='color: gray;'>{reading}</span> <span style='font-size: 60%;'>{meaning}</span>"
-                        )
-                    else:
-                        katakana_readings.append(
-                            f"{reading} <span style='font-size: 60%;'>{meaning}</span>"
-                        )
-
-            if "kunyomi" in kanji_entry:
-                for reading, details in kanji_entry["kunyomi"].items():
-                    meaning = details["meaning"]
-                    percentage = details["percentage"]
-                    if percentage < 1:
-                        hiragana_readings.append(
-                            f"<span style='color: gray;'>{reading}</span> <span style='font-size: 60%;'>{meaning}</span>"
-                        )
-                    else:
-                        hiragana_readings.append(
-                            f"{reading} <span style='font-size: 60%;'>{meaning}</span>"
-                        )
-
-            if "nanori" in kanji_entry:
-                for reading, details in kanji_entry["nanori"].items():
-                    meaning = details["meaning"]
-                    percentage = details["percentage"]
-                    if percentage < 1:
-                        names_readings.append(
-                            f"<span style='color: gray;'>{reading}</span> <span style='font-size: 60%;'>{meaning}</span>"
-                        )
-                    else:
-                        names_readings.append(
-                            f"{reading} <span style='font-size: 60%;'>{meaning}</span>"
-                        )
-
-            katakana_reading = "<br>".join(katakana_readings)
-            hiragana_reading = "<br>".join(hiragana_readings)
-            names_reading = "<br>".join(names_readings)
-
-            # Find the note IDs for the target kanji in Anki
-            note_ids = invoke(
-                "findNotes", query=f'"deck:All JLPT Kanjis" Kanji:{target_kanji}'
-            )
-
-            if not note_ids:
-                print(
-                    f"No notes found for '{target_kanji}' in the 'All JLPT Kanjis' deck"
-                )
-            else:
-                # Update each note
-                for note_id in note_ids:
-                    invoke(
-                        "updateNoteFields",
-                        note={
-                            "id": note_id,
-                            "fields": {
-                                "KatakanaReading": katakana_reading,
-                                "HiraganaReading": hiragana_reading,
-                                "NamesReadings": names_reading,
-                            },
-                        },
-                    )
+            actions.extend(prepare_note_updates(kanji_entry, note_ids))
+
+    # Updates are sent to Anki in batches through the "multi" action
+    batches = [
+        actions[start : start + ANKI_BATCH_SIZE]
+        for start in range(0, len(actions), ANKI_BATCH_SIZE)
+    ]
+    # AnkiConnect handles requests one at a time on Anki's main thread anyway
+    for batch in tqdm(batches, desc="Updating the Anki deck", unit="batch"):
+        invoke_multi(batch)
 
 
 if __name__ == "__main__":